@@ -1,18 +1,57 @@
 from flask import Flask, request, render_template, redirect, url_for, flash, Response
-import io, csv
+import io, csv, queue, threading
+from itertools import chain, islice
 from database import (
-    init_db, fetch_ingredients, add_ingredient, update_ingredient_by_id,
-    delete_ingredient_by_id, fetch_menu, create_dish, fetch_dish_ingredients,
-    update_dish, delete_dish, compute_low_stock_alerts, fetch_orders,
+    get_connection, init_db, close_db, fetch_ingredients, fetch_ingredient_by_id,
+    add_ingredient, update_ingredient_by_id, delete_ingredient_by_id, fetch_menu,
+    fetch_dish_by_id, create_dish, fetch_dish_ingredients, update_dish, delete_dish,
+    compute_low_stock_alerts, fetch_orders, fetch_order_by_id, iter_orders,
     create_order, vatRate
 )
 
 app = Flask(__name__)
 app.secret_key = "secretkey"
+app.teardown_appcontext(close_db)
 
 with app.app_context():
     init_db()
 
+# Form parsing - each helper returns (value, error message)
+def parse_positive(value, label):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None, f"Invalid {label}"
+    if number <= 0:
+        return None, f"{label.capitalize()} must be greater than 0"
+    return number, None
+
+def parse_dish_ingredients(form):
+    ingredients = []
+    for n, q, u in zip(form.getlist("item_name[]"), form.getlist("item_qty[]"), form.getlist("item_unit[]")):
+        n = n.strip()
+        if not n:
+            continue
+        try:
+            qty = float(q)
+        except ValueError:
+            return None, f"Invalid qty for ingredient '{n}'"
+        if qty <= 0:
+            return None, f"Ingredient '{n}' quantity must be greater than 0"
+        ingredients.append({"name": n, "qty_needed": qty, "unit": u.strip() or "pc"})
+    return ingredients, None
+
+def parse_order_items(form):
+    items = []
+    for did, q in zip(form.getlist("dish_id[]"), form.getlist("qty[]")):
+        if not did:
+            continue
+        qty = int(q) if q.strip().isdecimal() else 0
+        if qty <= 0:
+            continue
+        items.append({"dish_id": did, "qty": qty})
+    return items
+
 # Home
 @app.route("/")
 def index():
@@ -54,19 +93,7 @@ def new_order():
     dishes = fetch_menu()
     prefill = request.args.get("prefill")  # optional: pass dish id to preselect
     if request.method == "POST":
-        dish_ids = request.form.getlist("dish_id[]")
-        qtys = request.form.getlist("qty[]")
-        items = []
-        for did, q in zip(dish_ids, qtys):
-            if not did:
-                continue
-            try:
-                qty = int(q)
-            except Exception:
-                qty = 0
-            if qty <= 0:
-                continue
-            items.append({"dish_id": did, "qty": qty})
+        items = parse_order_items(request.form)
         if not items:
             flash("Select at least one dish with quantity greater than 0")
             return redirect(url_for("new_order"))
@@ -82,27 +109,96 @@ def new_order():
 # Orders details Route
 @app.route("/order/<int:order_id>")
 def order_detail(order_id):
-    orders = fetch_orders()
-    for o in orders:
-        if o["order"]["id"] == order_id:
-            return render_template("order_detail.html", order=o["order"], items=o["items"])
-    flash("Order not found")
-    return redirect(url_for("index"))
+    o = fetch_order_by_id(order_id)
+    if not o:
+        flash("Order not found")
+        return redirect(url_for("index"))
+    return render_template("order_detail.html", order=o["order"], items=o["items"])
 
 # Export CSV
+# rows are formatted on a worker thread and handed to the response through a bounded queue
+CSV_FLUSH_ROWS = 100
+CSV_QUEUE_SIZE = 64
+CSV_QUEUE_TIMEOUT = 30  # seconds to wait for the next chunk before giving up
+
+def produce_orders_csv(chunks, stop):
+    def put(chunk):
+        # give up if the client went away instead of blocking on a full queue forever
+        while not stop.is_set():
+            try:
+                chunks.put(chunk, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+
+    def flush():
+        data = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        return put(data)
+
+    conn = None
+    done = None  # last item on the queue: None when finished, the exception when the export failed
+    try:
+        # runs outside the request, so it needs its own connection instead of get_db()
+        conn = get_connection()
+        # the header goes out with the first batch so early failures still turn into an error response
+        writer.writerow(["order_id", "order_date", "dish_name", "qty", "line_price", "subtotal", "vat_rate", "vat_amount", "total"])
+
+        def order_rows():
+            for o in iter_orders(conn=conn):
+                order = o["order"]
+                for it in o["items"]:
+                    yield (order["id"], order.get("order_date_display", ""), it["dish_name"], it["quantity"], it["line_price"],
+                           order["subtotal"], order["vat_rate"], order["vat_amount"], order["total"])
+
+        rows = order_rows()
+        # write CSV_FLUSH_ROWS rows per writerows call and flush after each batch
+        while True:
+            batch = list(islice(rows, CSV_FLUSH_ROWS))
+            writer.writerows(batch)
+            if len(batch) < CSV_FLUSH_ROWS:
+                break
+            if not flush():
+                return
+        flush()
+    except Exception as e:
+        app.logger.exception("Orders CSV export failed")
+        done = e
+    finally:
+        if conn is not None:
+            conn.close()
+        put(done)
+
+def iter_csv_chunks(chunks, stop):
+    try:
+        while True:
+            try:
+                chunk = chunks.get(timeout=CSV_QUEUE_TIMEOUT)
+            except queue.Empty:
+                raise RuntimeError("Orders CSV export timed out")
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        stop.set()
+
 @app.route("/export/orders.csv")
 def export_orders_csv():
-    orders = fetch_orders()
-    si = io.StringIO()
-    writer = csv.writer(si)
-    writer.writerow(["order_id", "order_date", "dish_name", "qty", "line_price", "subtotal", "vat_rate", "vat_amount", "total"])
-    for o in orders:
-        order = o["order"]
-        for it in o["items"]:
-            writer.writerow([order["id"], order.get("order_date_display", ""), it["dish_name"], it["quantity"], it["line_price"],
-                             order["subtotal"], order["vat_rate"], order["vat_amount"], order["total"]])
-    output = si.getvalue()
-    return Response(output, mimetype="text/csv",
+    chunks = queue.Queue(maxsize=CSV_QUEUE_SIZE)
+    stop = threading.Event()
+    # one thread per export, so slow downloads never wait on each other
+    threading.Thread(target=produce_orders_csv, args=(chunks, stop), daemon=True).start()
+    stream = iter_csv_chunks(chunks, stop)
+    # wait for the first chunk here, so a failure before any data was sent is a 500 and not an empty CSV
+    first = next(stream, "")
+    return Response(chain((first,), stream), mimetype="text/csv",
                     headers={"Content-Disposition": "attachment;filename=orders.csv"})
 
 # Ingredients CRUD
@@ -113,13 +209,9 @@ def add_ingredient_route():
     if not name:
         flash("Ingredient name is required")
         return redirect(url_for("index"))
-    try:
-        quantity = float(request.form.get("quantity", 0))
-    except ValueError:
-        flash("Invalid quantity")
-        return redirect(url_for("index"))
-    if quantity <= 0:
-        flash("Quantity must be greater than 0")
+    quantity, err = parse_positive(request.form.get("quantity", 0), "quantity")
+    if err:
+        flash(err)
         return redirect(url_for("index"))
     unit = request.form.get("unit", "pc")
     ok, msg = add_ingredient(name, quantity, unit)
@@ -131,20 +223,15 @@ def add_ingredient_route():
 def edit_ingredient_route(ingredient_id):
     if request.method == "POST":
         new_name = request.form.get("new_name", "").strip()
-        try:
-            new_quantity = float(request.form.get("quantity", 0))
-        except ValueError:
-            flash("Invalid quantity")
-            return redirect(url_for("index"))
-        if new_quantity <= 0:
-            flash("Quantity must be greater than 0")
+        new_quantity, err = parse_positive(request.form.get("quantity", 0), "quantity")
+        if err:
+            flash(err)
             return redirect(url_for("index"))
         new_unit = request.form.get("unit", "pc")
         ok, msg = update_ingredient_by_id(ingredient_id, new_name, new_quantity, new_unit)
         flash(msg)
         return redirect(url_for("index"))
-    ing_list = fetch_ingredients()
-    ing = next((i for i in ing_list if i["id"] == ingredient_id), None)
+    ing = fetch_ingredient_by_id(ingredient_id)
     if not ing:
         flash("Ingredient not found")
         return redirect(url_for("index"))
@@ -166,31 +253,12 @@ def add_dish_route():
         if not name:
             flash("Dish name is required")
             return redirect(url_for("add_dish_route"))
-        try:
-            price = float(request.form.get("price", 0))
-        except ValueError:
-            flash("Invalid price")
-            return redirect(url_for("add_dish_route"))
-        if price <= 0:
-            flash("Price must be greater than 0")
+        price, err = parse_positive(request.form.get("price", 0), "price")
+        if not err:
+            ingredients, err = parse_dish_ingredients(request.form)
+        if err:
+            flash(err)
             return redirect(url_for("add_dish_route"))
-        ing_names = request.form.getlist("item_name[]")
-        ing_qtys = request.form.getlist("item_qty[]")
-        ing_units = request.form.getlist("item_unit[]")
-        ingredients = []
-        for n, q, u in zip(ing_names, ing_qtys, ing_units):
-            n = n.strip()
-            if not n:
-                continue
-            try:
-                qty = float(q)
-            except Exception:
-                flash(f"Invalid qty for ingredient '{n}'")
-                return redirect(url_for("add_dish_route"))
-            if qty <= 0:
-                flash(f"Ingredient '{n}' quantity must be greater than 0")
-                return redirect(url_for("add_dish_route"))
-            ingredients.append({"name": n, "qty_needed": qty, "unit": u.strip() or "pc"})
         ok, msg = create_dish(name, price, ingredients)
         flash(msg)
         return redirect(url_for("index"))
@@ -199,8 +267,7 @@ def add_dish_route():
 # Edit Dish Route
 @app.route("/edit_dish/<int:dish_id>", methods=["GET", "POST"])
 def edit_dish_route(dish_id):
-    dishes = fetch_menu()
-    dish = next((d for d in dishes if d["id"] == dish_id), None)
+    dish = fetch_dish_by_id(dish_id)
     if not dish:
         flash("Dish not found")
         return redirect(url_for("index"))
@@ -209,31 +276,12 @@ def edit_dish_route(dish_id):
         if not new_name:
             flash("Dish name is required")
             return redirect(url_for("edit_dish_route", dish_id=dish_id))
-        try:
-            new_price = float(request.form.get("price", 0))
-        except ValueError:
-            flash("Invalid price")
-            return redirect(url_for("edit_dish_route", dish_id=dish_id))
-        if new_price <= 0:
-            flash("Price must be greater than 0")
+        new_price, err = parse_positive(request.form.get("price", 0), "price")
+        if not err:
+            ingredients, err = parse_dish_ingredients(request.form)
+        if err:
+            flash(err)
             return redirect(url_for("edit_dish_route", dish_id=dish_id))
-        ing_names = request.form.getlist("item_name[]")
-        ing_qtys = request.form.getlist("item_qty[]")
-        ing_units = request.form.getlist("item_unit[]")
-        ingredients = []
-        for n, q, u in zip(ing_names, ing_qtys, ing_units):
-            n = n.strip()
-            if not n:
-                continue
-            try:
-                qty = float(q)
-            except Exception:
-                flash(f"Invalid qty for ingredient '{n}'")
-                return redirect(url_for("edit_dish_route", dish_id=dish_id))
-            if qty <= 0:
-                flash(f"Ingredient '{n}' quantity must be greater than 0")
-                return redirect(url_for("edit_dish_route", dish_id=dish_id))
-            ingredients.append({"name": n, "qty_needed": qty, "unit": u.strip() or "pc"})
         ok, msg = update_dish(dish_id, new_name, new_price, ingredients)
         flash(msg)
         return redirect(url_for("index"))
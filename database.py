@@ -1,20 +1,91 @@
+import re
 import sqlite3
-from datetime import datetime, date
+import time
+from datetime import datetime, date, timedelta
+from flask import g
 
 DB_PATH = "inventory.db"
 allowed_units = {"g", "pc", "ml"}
 vatRate = 0.21  # 21%
+_ISO_DATE_RE = re.compile(r"(\d{4}-\d{2}-\d{2})")
+_DMY_DATE_RE = re.compile(r"(\d{2})[-/](\d{2})[-/](\d{4})$")
+
+# SQL statements used by the helpers below, named for readability
+SQL_SELECT_INGREDIENT = "SELECT * FROM stock_inventory WHERE id = ?"
+SQL_INSERT_INGREDIENT = "INSERT INTO stock_inventory (ingredient_name, quantity_in_stock, unit) VALUES (?, ?, ?)"
+SQL_UPDATE_INGREDIENT = "UPDATE stock_inventory SET ingredient_name = ?, quantity_in_stock = ?, unit = ? WHERE id = ?"
+SQL_DELETE_INGREDIENT = "DELETE FROM stock_inventory WHERE id = ?"
+SQL_UPDATE_STOCK = "UPDATE stock_inventory SET quantity_in_stock = ? WHERE id = ?"
+SQL_SELECT_DISH = "SELECT id, dish_name, dish_price FROM menu_inventory WHERE id = ?"
+SQL_INSERT_DISH = "INSERT INTO menu_inventory (dish_name, dish_price) VALUES (?, ?)"
+SQL_UPDATE_DISH = "UPDATE menu_inventory SET dish_name = ?, dish_price = ? WHERE id = ?"
+SQL_DELETE_DISH = "DELETE FROM menu_inventory WHERE id = ?"
+SQL_INSERT_DISH_INGREDIENT = "INSERT INTO dish_ingredients (menu_id, ingredient_id, quantity_needed) VALUES (?, ?, ?)"
+SQL_DELETE_DISH_INGREDIENTS = "DELETE FROM dish_ingredients WHERE menu_id = ?"
+SQL_SELECT_DISH_INGREDIENTS = """SELECT di.quantity_needed, si.id as ing_id, si.ingredient_name, si.quantity_in_stock, si.unit
+           FROM dish_ingredients di
+           JOIN stock_inventory si ON si.id = di.ingredient_id
+           WHERE di.menu_id = ?"""
+SQL_LOW_STOCK_ALERTS = """SELECT si.ingredient_name, si.quantity_in_stock, si.unit, MAX(di.quantity_needed) AS max_needed
+           FROM dish_ingredients di
+           JOIN stock_inventory si ON si.id = di.ingredient_id
+           GROUP BY si.id
+           HAVING si.quantity_in_stock < 3 * MAX(di.quantity_needed)"""
+SQL_INSERT_ORDER = "INSERT INTO orders (subtotal, vat_rate, vat_amount, total) VALUES (?, ?, ?, ?)"
+SQL_INSERT_ORDER_ITEM = "INSERT INTO order_items (order_id, dish_id, quantity, line_price) VALUES (?, ?, ?, ?)"
+SQL_SELECT_ORDERS = """SELECT o.id, o.order_date, o.subtotal, o.vat_rate, o.vat_amount, o.total,
+                    oi.quantity, oi.line_price, m.dish_name
+             FROM orders o
+             LEFT JOIN order_items oi ON oi.order_id = o.id
+             LEFT JOIN menu_inventory m ON m.id = oi.dish_id
+             WHERE 1=1"""
+SQL_SELECT_ORDER = SQL_SELECT_ORDERS + " AND o.id = ?"
 
 # Database setup
 def get_connection():
-    conn = sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES)
+    # the statement cache is keyed by SQL text; a larger one keeps more of the recurring queries prepared
+    conn = sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES, cached_statements=256)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA foreign_keys = ON;")
+    conn.execute("PRAGMA synchronous = NORMAL;")
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    conn.execute("PRAGMA mmap_size = 268435456;")  # 256 MB
+    conn.execute("PRAGMA cache_size = -20000;")  # ~20 MB
+    return conn
+
+# One connection per request, opened on first use and closed on app context teardown
+def get_db():
+    conn = g.get("_db")
+    if conn is None:
+        conn = g._db = get_connection()
     return conn
 
+def close_db(exc=None):
+    conn = g.pop("_db", None)
+    if conn is not None:
+        conn.close()
+
+# In-process cache for hot unfiltered reads, cleared after every write that affects them
+CACHE_TIMEOUT = 60  # seconds
+_cache = {}
+
+def cached(key, loader):
+    hit = _cache.get(key)
+    now = time.monotonic()
+    if hit is not None and now - hit[0] < CACHE_TIMEOUT:
+        return hit[1]
+    value = loader()
+    _cache[key] = (now, value)
+    return value
+
+def clear_cache():
+    _cache.clear()
+
 # Create tables
 def init_db():
-    conn = get_connection()
+    conn = get_db()
+    # WAL is persistent in the database file, so it only needs to be set once
+    conn.execute("PRAGMA journal_mode = WAL;")
     with conn:
         conn.execute("""
             CREATE TABLE IF NOT EXISTS stock_inventory (
@@ -67,23 +138,85 @@ def init_db():
             )
                      """)
 
-    conn.close()
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_date ON orders (order_date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items (order_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_dish_ingredients_menu ON dish_ingredients (menu_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_dish_ingredients_ing ON dish_ingredients (ingredient_id)")
+
+        # trigram full text indexes so "name contains" filters don't scan the whole table
+        create_name_index(conn, "stock_inventory", "ingredient_name")
+        create_name_index(conn, "menu_inventory", "dish_name")
 
-# Utilities - validate unit and ensure ingredient exists
+# FTS5 index over one name column, kept in sync with its table by triggers
+def create_name_index(conn, table: str, column: str):
+    fts = f"{table}_fts"
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (fts,)).fetchone()
+    conn.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {fts}
+        USING fts5({column}, content='{table}', content_rowid='id', tokenize='trigram')
+                 """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_ai AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts} (rowid, {column}) VALUES (new.id, new.{column});
+        END
+                 """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_ad AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+        END
+                 """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_au AFTER UPDATE OF {column} ON {table} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+            INSERT INTO {fts} (rowid, {column}) VALUES (new.id, new.{column});
+        END
+                 """)
+    if not exists:
+        # index rows that were added before the FTS table existed
+        conn.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+
+# Utilities - validate units and resolve dish ingredients
 def validate_unit(unit):
     unit = (unit or "").strip()
     return unit if unit in allowed_units else None
 
-def ensure_ingredient_exists(conn, ingredient_name: str, unit: str):
-    row = conn.execute("SELECT id, unit FROM stock_inventory WHERE ingredient_name = ?", (ingredient_name,)).fetchone()
-    if row:
-        if row["unit"] != unit:
-            return None, f"Unit mismatch for {ingredient_name}: existing '{row['unit']}', given '{unit}'"
-        return row["id"], None
-    conn.execute("INSERT INTO stock_inventory (ingredient_name, quantity_in_stock, unit) VALUES (?, ?, ?)",
-                 (ingredient_name, 0, unit))
-    row = conn.execute("SELECT id FROM stock_inventory WHERE ingredient_name = ?", (ingredient_name,)).fetchone()
-    return row["id"], None
+# Validate dish ingredients and map them to stock ids, creating missing ingredients with 0 stock
+def resolve_ingredients(conn, ingredients: list):
+    parsed = []
+    for ing in ingredients:
+        unit = ing.get("unit")
+        if not validate_unit(unit):
+            raise ValueError(f"Invalid unit for {ing.get('name')}")
+        qty = float(ing.get("qty_needed"))
+        if qty <= 0:
+            raise ValueError(f"Quantity needed must be greater than 0 for {ing.get('name')}")
+        parsed.append((ing["name"], unit, qty))
+    if not parsed:
+        return []
+
+    names = list(dict.fromkeys(name for name, _, _ in parsed))
+    rows = conn.execute(
+        f"SELECT id, ingredient_name, unit FROM stock_inventory WHERE ingredient_name IN ({','.join('?' * len(names))})",
+        names
+    ).fetchall()
+    ids = {r["ingredient_name"]: r["id"] for r in rows}
+    units = {r["ingredient_name"]: r["unit"] for r in rows}
+    missing = {}
+    for name, unit, _ in parsed:
+        existing = units.get(name, missing.get(name))
+        if existing is None:
+            missing[name] = unit
+        elif existing != unit:
+            raise ValueError(f"Unit mismatch for {name}: existing '{existing}', given '{unit}'")
+
+    if missing:
+        conn.executemany(SQL_INSERT_INGREDIENT, [(name, 0, unit) for name, unit in missing.items()])
+        rows = conn.execute(
+            f"SELECT id, ingredient_name FROM stock_inventory WHERE ingredient_name IN ({','.join('?' * len(missing))})",
+            list(missing)
+        ).fetchall()
+        ids.update((r["ingredient_name"], r["id"]) for r in rows)
+    return [(ids[name], qty) for name, _, qty in parsed]
 
 # Add Ingredients
 def add_ingredient(name: str, quantity: float, unit: str):
@@ -92,31 +225,31 @@ def add_ingredient(name: str, quantity: float, unit: str):
     unit = validate_unit(unit)
     if not unit:
         return False, f"Unit must be one of {sorted(allowed_units)}"
-    conn = get_connection()
+    conn = get_db()
     try:
         with conn:
-            conn.execute("INSERT INTO stock_inventory (ingredient_name, quantity_in_stock, unit) VALUES (?, ?, ?)",
-                         (name, quantity, unit))
+            conn.execute(SQL_INSERT_INGREDIENT, (name, quantity, unit))
         return True, "Ingredient added"
     except sqlite3.IntegrityError:
         return False, "Ingredient already exists"
-    finally:
-        conn.close()
 
 # List Ingredients
 def fetch_ingredients(filter_name=None, filter_quantity=None, op="ge"):
-    conn = get_connection()
+    conn = get_db()
     sql = "SELECT * FROM stock_inventory WHERE 1=1"
     params = []
     if filter_name:
-        sql += " AND ingredient_name LIKE ?"
+        sql += " AND id IN (SELECT rowid FROM stock_inventory_fts WHERE ingredient_name LIKE ?)"
         params.append(f"%{filter_name}%")
     if filter_quantity is not None:
         sql += " AND quantity_in_stock >= ?" if op == "ge" else " AND quantity_in_stock <= ?"
         params.append(filter_quantity)
-    rows = conn.execute(sql, params).fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    return conn.execute(sql, params).fetchall()
+
+# Fetch a single ingredient
+def fetch_ingredient_by_id(ingredient_id: int):
+    conn = get_db()
+    return conn.execute(SQL_SELECT_INGREDIENT, (ingredient_id,)).fetchone()
 
 # Update Ingredients
 def update_ingredient_by_id(ingredient_id: int, name: str, quantity: float, unit: str):
@@ -125,21 +258,20 @@ def update_ingredient_by_id(ingredient_id: int, name: str, quantity: float, unit
     unit = validate_unit(unit)
     if not unit:
         return False, f"Unit must be one of {sorted(allowed_units)}"
-    conn = get_connection()
+    conn = get_db()
     with conn:
-        c = conn.execute("UPDATE stock_inventory SET ingredient_name = ?, quantity_in_stock = ?, unit = ? WHERE id = ?",
-                         (name, quantity, unit, ingredient_id))
+        c = conn.execute(SQL_UPDATE_INGREDIENT, (name, quantity, unit, ingredient_id))
         ok = c.rowcount != 0
-    conn.close()
+    clear_cache()
     return (True, "Ingredient updated") if ok else (False, "Ingredient not found")
 
 # Delete Ingredients
 def delete_ingredient_by_id(ingredient_id: int):
-    conn = get_connection()
+    conn = get_db()
     with conn:
-        c = conn.execute("DELETE FROM stock_inventory WHERE id = ?", (ingredient_id,))
+        c = conn.execute(SQL_DELETE_INGREDIENT, (ingredient_id,))
         ok = c.rowcount != 0
-    conn.close()
+    clear_cache()
     return (True, "Ingredient deleted") if ok else (False, f"Ingredient {ingredient_id} not found")
 
 # Menu / Dishes
@@ -147,247 +279,232 @@ def delete_ingredient_by_id(ingredient_id: int):
 def create_dish(dish_name: str, dish_price: float, ingredients: list):
     if dish_price <= 0:
         return False, "Price must be greater than 0"
-    conn = get_connection()
+    conn = get_db()
     try:
         with conn:
-            conn.execute("INSERT INTO menu_inventory (dish_name, dish_price) VALUES (?, ?)", (dish_name, dish_price))
-            dish_id = conn.execute("SELECT id FROM menu_inventory WHERE dish_name = ?", (dish_name,)).fetchone()["id"]
-            for ing in ingredients:
-                unit = ing.get("unit")
-                if not validate_unit(unit):
-                    raise ValueError(f"Invalid unit for {ing.get('name')}")
-                qty = float(ing.get("qty_needed"))
-                if qty <= 0:
-                    raise ValueError(f"Quantity needed must be greater than 0 for {ing.get('name')}")
-                ing_id, err = ensure_ingredient_exists(conn, ing["name"], unit)
-                if err:
-                    raise ValueError(err)
-                conn.execute("INSERT INTO dish_ingredients (menu_id, ingredient_id, quantity_needed) VALUES (?, ?, ?)",
-                             (dish_id, ing_id, qty))
+            dish_id = conn.execute(SQL_INSERT_DISH, (dish_name, dish_price)).lastrowid
+            conn.executemany(SQL_INSERT_DISH_INGREDIENT,
+                             [(dish_id, ing_id, qty) for ing_id, qty in resolve_ingredients(conn, ingredients)])
+        clear_cache()
         return True, f"Dish '{dish_name}' created"
     except sqlite3.IntegrityError:
         return False, "Dish already exists"
     except Exception as e:
         return False, str(e)
-    finally:
-        conn.close()
 
 # List Dishes
 def fetch_menu(filter_name=None, filter_price=None, price_op="le"):
-    conn = get_connection()
+    if not filter_name and filter_price is None:
+        return cached("menu", _load_menu)
+    return _load_menu(filter_name, filter_price, price_op)
+
+def _load_menu(filter_name=None, filter_price=None, price_op="le"):
+    conn = get_db()
     sql = "SELECT * FROM menu_inventory WHERE 1=1"
     params = []
     if filter_name:
-        sql += " AND dish_name LIKE ?"
+        sql += " AND id IN (SELECT rowid FROM menu_inventory_fts WHERE dish_name LIKE ?)"
         params.append(f"%{filter_name}%")
     if filter_price is not None:
         sql += " AND dish_price <= ?" if price_op == "le" else " AND dish_price >= ?"
         params.append(filter_price)
-    rows = conn.execute(sql, params).fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    return conn.execute(sql, params).fetchall()
+
+# Fetch a single dish
+def fetch_dish_by_id(dish_id: int):
+    conn = get_db()
+    return conn.execute(SQL_SELECT_DISH, (dish_id,)).fetchone()
 
 # Fetch all ingredients required for a specific dish
 def fetch_dish_ingredients(dish_id: int):
-    conn = get_connection()
-    rows = conn.execute(
-        """SELECT di.quantity_needed, si.id as ing_id, si.ingredient_name, si.quantity_in_stock, si.unit
-           FROM dish_ingredients di
-           JOIN stock_inventory si ON si.id = di.ingredient_id
-           WHERE di.menu_id = ?""", (dish_id,)
-    ).fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    conn = get_db()
+    return conn.execute(SQL_SELECT_DISH_INGREDIENTS, (dish_id,)).fetchall()
 
 # Update Dish
 def update_dish(dish_id: int, new_name: str, new_price: float, new_ingredients: list):
     if new_price <= 0:
         return False, "Price must be greater than 0"
-    conn = get_connection()
-    with conn:
-        row = conn.execute("SELECT id FROM menu_inventory WHERE id = ?", (dish_id,)).fetchone()
-        if not row:
-            conn.close()
-            return False, f"Dish {dish_id} not found"
-        conn.execute("UPDATE menu_inventory SET dish_name = ?, dish_price = ? WHERE id = ?", (new_name, new_price, dish_id))
-        conn.execute("DELETE FROM dish_ingredients WHERE menu_id = ?", (dish_id,))
-        for ing in new_ingredients:
-            unit = ing.get("unit")
-            if not validate_unit(unit):
-                conn.close()
-                return False, f"Invalid unit for {ing.get('name')}"
-            qty = float(ing.get("qty_needed"))
-            if qty <= 0:
-                conn.close()
-                return False, f"Quantity needed must be greater than 0 for {ing.get('name')}"
-            ing_id, err = ensure_ingredient_exists(conn, ing["name"], unit)
-            if err:
-                conn.close()
-                return False, err
-            conn.execute("INSERT INTO dish_ingredients (menu_id, ingredient_id, quantity_needed) VALUES (?, ?, ?)",
-                         (dish_id, ing_id, qty))
-    conn.close()
-    return True, "Dish updated"
+    conn = get_db()
+    try:
+        with conn:
+            cur = conn.execute(SQL_UPDATE_DISH, (new_name, new_price, dish_id))
+            if cur.rowcount == 0:
+                return False, f"Dish {dish_id} not found"
+            conn.execute(SQL_DELETE_DISH_INGREDIENTS, (dish_id,))
+            conn.executemany(SQL_INSERT_DISH_INGREDIENT,
+                             [(dish_id, ing_id, qty) for ing_id, qty in resolve_ingredients(conn, new_ingredients)])
+        return True, "Dish updated"
+    except sqlite3.IntegrityError:
+        return False, "Dish already exists"
+    except ValueError as e:
+        return False, str(e)
+    finally:
+        clear_cache()
 
 # Delete Dish
 def delete_dish(dish_id: int):
-    conn = get_connection()
+    conn = get_db()
     with conn:
-        c = conn.execute("DELETE FROM menu_inventory WHERE id = ?", (dish_id,))
+        c = conn.execute(SQL_DELETE_DISH, (dish_id,))
         ok = c.rowcount != 0
-    conn.close()
+    clear_cache()
     return (True, "Dish deleted") if ok else (False, "Dish not found")
 
 # Orders and alerts
 def compute_low_stock_alerts():
-    conn = get_connection()
-    rows = conn.execute(
-        """SELECT si.ingredient_name, si.quantity_in_stock, si.unit, di.quantity_needed
-           FROM dish_ingredients di
-           JOIN stock_inventory si ON si.id = di.ingredient_id"""
-    ).fetchall()
-    alerts = []
-    seen = set()
-    for r in rows:
-        threshold = 3 * r["quantity_needed"]
-        if r["quantity_in_stock"] < threshold:
-            key = (r["ingredient_name"], r["unit"])
-            if key in seen:
-                continue
-            seen.add(key)
-            alerts.append({
-                "ingredient": r["ingredient_name"],
-                "stock": r["quantity_in_stock"],
-                "unit": r["unit"],
-                "threshold": threshold
-            })
-    conn.close()
-    return alerts
+    return cached("alerts", _load_low_stock_alerts)
+
+def _load_low_stock_alerts():
+    conn = get_db()
+    rows = conn.execute(SQL_LOW_STOCK_ALERTS).fetchall()
+    return [{
+        "ingredient": r["ingredient_name"],
+        "stock": r["quantity_in_stock"],
+        "unit": r["unit"],
+        "threshold": 3 * r["max_needed"]
+    } for r in rows]
 
 # Create Order
 def create_order(items: list):
-    conn = get_connection()
+    conn = get_db()
     try:
-        dish_map = {}
+        # take the write lock up front so stock can't change between the checks and the update
+        conn.execute("BEGIN IMMEDIATE")
+        lines = []
+        unique = {}  # total quantity ordered per dish
+        dish_names = {}
         subtotal = 0.0
         # validate items and compute subtotal
         for it in items:
             dish_id = int(it["dish_id"])
             qty = int(it["qty"])
             if qty <= 0:
-                return False, "Quantity must be >= 1"
-            row = conn.execute("SELECT id, dish_name, dish_price FROM menu_inventory WHERE id = ?", (dish_id,)).fetchone()
+                raise ValueError("Quantity must be >= 1")
+            row = conn.execute(SQL_SELECT_DISH, (dish_id,)).fetchone()
             if not row:
-                return False, f"Dish id {dish_id} not found"
-            dish_map[dish_id] = {"name": row["dish_name"], "price": float(row["dish_price"])}
-            subtotal += float(row["dish_price"]) * qty
+                raise ValueError(f"Dish id {dish_id} not found")
+            price = float(row["dish_price"])
+            dish_names[dish_id] = row["dish_name"]
+            unique[dish_id] = unique.get(dish_id, 0) + qty
+            lines.append((dish_id, qty, round(price * qty, 2)))
+            subtotal += price * qty
 
         vat_amount = round(subtotal * vatRate, 2)
         total = round(subtotal + vat_amount, 2)
 
+        # load the ingredients of all ordered dishes in one query
+        placeholders = ",".join("?" * len(unique))
+        ing_rows = conn.execute(
+            "SELECT di.menu_id, di.ingredient_id, di.quantity_needed, si.ingredient_name, si.quantity_in_stock, si.unit "
+            f"FROM dish_ingredients di JOIN stock_inventory si ON si.id = di.ingredient_id WHERE di.menu_id IN ({placeholders})",
+            list(unique)
+        ).fetchall()
+        dishes_with_ings = {r["menu_id"] for r in ing_rows}
+        for dish_id in unique:
+            if dish_id not in dishes_with_ings:
+                raise ValueError(f"Dish {dish_names[dish_id]} has no ingredients defined")
+
         # accumulate ingredient needs
         needs = {}
-        for it in items:
-            dish_id = int(it["dish_id"])
-            qty = int(it["qty"])
-            ing_rows = conn.execute(
-                "SELECT di.ingredient_id, di.quantity_needed, si.ingredient_name, si.quantity_in_stock, si.unit "
-                "FROM dish_ingredients di JOIN stock_inventory si ON si.id = di.ingredient_id WHERE di.menu_id = ?",
-                (dish_id,)
-            ).fetchall()
-            if not ing_rows:
-                return False, f"Dish {dish_map[dish_id]['name']} has no ingredients defined"
-            for r in ing_rows:
-                tot_needed = float(r["quantity_needed"]) * qty
-                iid = r["ingredient_id"]
-                if iid in needs:
-                    needs[iid]["needed"] += tot_needed
-                else:
-                    needs[iid] = {"name": r["ingredient_name"], "unit": r["unit"], "needed": tot_needed, "stock": r["quantity_in_stock"]}
+        for r in ing_rows:
+            tot_needed = float(r["quantity_needed"]) * unique[r["menu_id"]]
+            iid = r["ingredient_id"]
+            if iid in needs:
+                needs[iid]["needed"] += tot_needed
+            else:
+                needs[iid] = {"name": r["ingredient_name"], "unit": r["unit"], "needed": tot_needed, "stock": r["quantity_in_stock"]}
 
         # check stock sufficiency
         for iid, info in needs.items():
             if info["stock"] < info["needed"]:
-                return False, f"Not enough {info['name']} (need {info['needed']}{info['unit']}, have {info['stock']}{info['unit']})"
+                raise ValueError(f"Not enough {info['name']} (need {info['needed']}{info['unit']}, have {info['stock']}{info['unit']})")
 
-        # insert order and subtract stock atomically
-        with conn:
-            cur = conn.execute("INSERT INTO orders (subtotal, vat_rate, vat_amount, total) VALUES (?, ?, ?, ?)",
-                               (round(subtotal, 2), vatRate, vat_amount, total))
-            order_id = cur.lastrowid
-            for it in items:
-                dish_id = int(it["dish_id"])
-                qty = int(it["qty"])
-                line_price = round(dish_map[dish_id]["price"] * qty, 2)
-                conn.execute("INSERT INTO order_items (order_id, dish_id, quantity, line_price) VALUES (?, ?, ?, ?)",
-                             (order_id, dish_id, qty, line_price))
-            for iid, info in needs.items():
-                new_stock = info["stock"] - info["needed"]
-                conn.execute("UPDATE stock_inventory SET quantity_in_stock = ? WHERE id = ?", (new_stock, iid))
-        return True, order_id
+        # insert order and subtract stock
+        cur = conn.execute(SQL_INSERT_ORDER, (round(subtotal, 2), vatRate, vat_amount, total))
+        order_id = cur.lastrowid
+        conn.executemany(SQL_INSERT_ORDER_ITEM, [(order_id, dish_id, qty, line_price) for dish_id, qty, line_price in lines])
+        conn.executemany(SQL_UPDATE_STOCK,
+                         [(info["stock"] - info["needed"], iid) for iid, info in needs.items()])
+        conn.commit()
     except Exception as e:
+        conn.rollback()
         return False, str(e)
-    finally:
-        conn.close()
+    clear_cache()
+    return True, order_id
+
+# Format an order date for display as YYYY-MM-DD
+def format_order_date(raw):
+    # PARSE_DECLTYPES returns datetime for TIMESTAMP columns, so check that first
+    if isinstance(raw, (datetime, date)):
+        return raw.strftime("%Y-%m-%d")
+    if raw is None:
+        return ""
+    if isinstance(raw, str):
+        m = _ISO_DATE_RE.match(raw)
+        if m:
+            return m.group(1)
+        m = _DMY_DATE_RE.match(raw)
+        if m:
+            return f"{m.group(3)}-{m.group(2)}-{m.group(1)}"
+        return raw
+    return str(raw)
+
+# Parse a YYYY-MM-DD filter value, None if it is not a valid date
+def parse_day(value):
+    try:
+        return date.fromisoformat(value.strip()[:10])
+    except ValueError:
+        return None
 
 # List Orders
-def fetch_orders(filter_name=None, start_date=None, end_date=None):
-    conn = get_connection()
-    sql = """SELECT o.id, o.order_date, o.subtotal, o.vat_rate, o.vat_amount, o.total
-             FROM orders o
-             WHERE 1=1"""
+def iter_orders(filter_name=None, start_date=None, end_date=None, conn=None):
+    conn = conn or get_db()
+    sql = SQL_SELECT_ORDERS
     params = []
+    # compare the raw column against day boundaries so idx_orders_date can be used
     if start_date:
-        sql += " AND date(o.order_date) >= date(?)"
-        params.append(start_date)
+        day = parse_day(start_date)
+        if day is None:
+            return
+        sql += " AND o.order_date >= ?"
+        params.append(f"{day.isoformat()} 00:00:00")
     if end_date:
-        sql += " AND date(o.order_date) <= date(?)"
-        params.append(end_date)
-    sql += " ORDER BY o.order_date DESC"
-    rows = conn.execute(sql, params).fetchall()
-    results = []
+        day = parse_day(end_date)
+        if day is None:
+            return
+        # the last representable day has no next day, and every order date is before its end anyway
+        if day < date.max:
+            sql += " AND o.order_date < ?"
+            params.append(f"{(day + timedelta(days=1)).isoformat()} 00:00:00")
+    if filter_name:
+        sql += """ AND EXISTS (SELECT 1 FROM order_items oi2
+                               WHERE oi2.order_id = o.id
+                               AND oi2.dish_id IN (SELECT rowid FROM menu_inventory_fts WHERE dish_name LIKE ?))"""
+        params.append(f"%{filter_name}%")
+    sql += " ORDER BY o.order_date DESC, o.id"
+    yield from group_order_rows(conn.execute(sql, params))
+
+# Build {"order": ..., "items": [...]} entries from order JOIN rows
+def group_order_rows(rows):
+    # rows of one order are adjacent, so each order is yielded as soon as the next one starts
+    entry = None
     for r in rows:
-        order = dict(r)
-        raw = order.get("order_date")
-        display = ""
-        try:
-            if raw is None:
-                display = ""
-            elif isinstance(raw, str):
-                # try iso parse first
-                try:
-                    dt = datetime.fromisoformat(raw)
-                    display = dt.strftime("%Y-%m-%d")
-                except Exception:
-                    # try common formats
-                    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d", "%d-%m-%Y", "%d/%m/%Y"):
-                        try:
-                            dt = datetime.strptime(raw, fmt)
-                            display = dt.strftime("%Y-%m-%d")
-                            break
-                        except Exception:
-                            continue
-                    if display == "":
-                        display = raw
-            elif isinstance(raw, datetime):
-                display = raw.strftime("%Y-%m-%d")
-            elif isinstance(raw, date):
-                display = raw.strftime("%Y-%m-%d")
-            else:
-                display = str(raw)
-        except Exception:
-            display = str(raw)
-        order["order_date_display"] = display
-
-        items_rows = conn.execute(
-            """SELECT oi.quantity, oi.line_price, m.dish_name
-               FROM order_items oi JOIN menu_inventory m ON m.id = oi.dish_id
-               WHERE oi.order_id = ?""", (order["id"],)
-        ).fetchall()
-        items = [dict(it) for it in items_rows]
-        if filter_name:
-            if not any(filter_name.lower() in it["dish_name"].lower() for it in items):
-                continue
-        results.append({"order": order, "items": items})
-    conn.close()
-    return results
+        if entry is None or entry["order"]["id"] != r["id"]:
+            if entry is not None:
+                yield entry
+            order = {k: r[k] for k in ("id", "order_date", "subtotal", "vat_rate", "vat_amount", "total")}
+            order["order_date_display"] = format_order_date(order["order_date"])
+            entry = {"order": order, "items": []}
+        # the JOIN row itself serves as the item, it has quantity, line_price and dish_name
+        if r["dish_name"] is not None:
+            entry["items"].append(r)
+    if entry is not None:
+        yield entry
+
+def fetch_orders(filter_name=None, start_date=None, end_date=None):
+    return list(iter_orders(filter_name=filter_name, start_date=start_date, end_date=end_date))
+
+# Fetch a single order with its items
+def fetch_order_by_id(order_id: int):
+    conn = get_db()
+    return next(group_order_rows(conn.execute(SQL_SELECT_ORDER, (order_id,))), None)